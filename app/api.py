@@ -1,5 +1,10 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from os import getenv
+import sys
+from threading import Lock
+from time import monotonic
 from dotenv import load_dotenv
 from fastapi import FastAPI, Response, HTTPException, Depends, Cookie
 from fastapi.middleware.cors import CORSMiddleware
@@ -17,9 +22,37 @@ load_dotenv()
 SUPABASE_URL = getenv("SUPABASE_URL")
 SUPABASE_KEY = getenv("SUPABASE_KEY")
 
+# Number of expense rows sent to supabase per request
+BATCH_SIZE = int(getenv("BATCH_SIZE", 1000))
+# Number of batches sent to supabase at the same time
+MAX_CONCURRENT_BATCHES = int(getenv("MAX_CONCURRENT_BATCHES", 4))
+# Mails dated this long before the last stored expense are still upserted when fetching
+# new expenses, since a mail can arrive later than its Date header says
+NEW_EXPENSES_GRACE_PERIOD = timedelta(hours=int(getenv("NEW_EXPENSES_GRACE_HOURS", 6)))
+
 # Create supabase client
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# The PostgREST client holds a single keep-alive HTTP/2 httpx session that every table
+# and rpc call reuses. Creating it lazily could race between the threadpool workers
+# serving requests and build more than one connection pool
+_ = supabase.postgrest  # build the shared PostgREST client eagerly
+
+# Guards the in-process caches below, which are shared by threadpool workers
+cache_lock = Lock()
+
+# In-process cache of sessions - session_token -> ((user, expiry_date), cached_at)
+# A revoked session can stay valid for at most SESSION_CACHE_TTL seconds
+SESSION_CACHE_TTL = 60
+SESSION_CACHE_MAX_SIZE = 10_000
+session_cache = {}
+
+# In-process cache of expense counts - user_id -> (count, cached_at)
+# Entries are dropped whenever expenses of the user are upserted
+EXPENSE_COUNT_CACHE_TTL = 30
+EXPENSE_COUNT_CACHE_MAX_SIZE = 10_000
+expense_count_cache = {}
+
 # Initiate API app
 app = FastAPI()
 
@@ -59,6 +92,20 @@ async def http_exception_handler(request, exception):
     )
 
 
+def cache_put(cache, key, value, max_size):
+    """Store value with the current time, dropping the oldest entry once cache is full"""
+    with cache_lock:
+        if key not in cache and len(cache) >= max_size:
+            cache.pop(next(iter(cache)))
+        cache[key] = (value, monotonic())
+
+
+def cache_pop(cache, key):
+    """Remove key from cache if present"""
+    with cache_lock:
+        cache.pop(key, None)
+
+
 def api_response(message, data=None, status="success"):
     """Create JSONResponse for success message passed"""
     response = {"status": status, "message": message}
@@ -67,9 +114,20 @@ def api_response(message, data=None, status="success"):
     return JSONResponse(content=response, status_code=200)
 
 
+def chunked(items, size):
+    """Yield successive slices of items having at most size elements"""
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+@lru_cache(maxsize=4096)
 def get_proper_iso_format(date_str):
     """Fix the datetime to proper ISO format"""
     try:
+        # Python 3.11+ parses any number of fractional second digits by itself
+        if sys.version_info >= (3, 11):
+            return datetime.fromisoformat(date_str)
+
         date_part, time_part = date_str.split("T")
         time_main, ms_part = time_part.split(".")
 
@@ -83,17 +141,27 @@ def get_proper_iso_format(date_str):
         return None
 
 
-async def verify_session(session_token: Optional[str] = Cookie(None)):
+def verify_session(session_token: Optional[str] = Cookie(None)):
     """Verify is session is passed. If yes, then check validity of the session"""
 
     # Raise exception if session token is not passed
     if not session_token:
         raise HTTPException(status_code=401, detail="Session Token not provided")
 
-    # Query the session table to get the valid session
+    # Return the cached user if the session was verified recently and has not expired
+    cached = session_cache.get(session_token)
+    if cached is not None:
+        (user, expiry_date), cached_at = cached
+        is_fresh = monotonic() - cached_at < SESSION_CACHE_TTL
+        if is_fresh and expiry_date >= datetime.now():
+            return user
+        cache_pop(session_cache, session_token)
+
+    # Query the session table along with the user it belongs to in a single request
+    # The user is embedded through the session.user_id -> user.id foreign key
     session_data = (
         supabase.table("session")
-        .select("id, user_id, expires_at")
+        .select("id, expires_at, user:user_id(id, role)")
         .eq("token", session_token)
         .limit(1)
         .execute()
@@ -111,22 +179,17 @@ async def verify_session(session_token: Optional[str] = Cookie(None)):
             status_code=500, detail="Could not parse session expiry date"
         )
     if expiry_date < datetime.now():
+        cache_pop(session_cache, session_token)
         raise HTTPException(status_code=401, detail="Session expired")
 
-    # Get the user associated with this session
-    user_data = (
-        supabase.table("user")
-        .select("id, role")
-        .eq("id", session["user_id"])
-        .limit(1)
-        .execute()
-    )
-
     # Check if user exists
-    if not user_data.data:
+    user = session.get("user")
+    if not user:
         raise HTTPException(status_code=401, detail="User not found")
 
-    return user_data.data[0]
+    cache_put(session_cache, session_token, (user, expiry_date), SESSION_CACHE_MAX_SIZE)
+
+    return user
 
 
 async def verify_admin_session(user: dict = Depends(verify_session)):
@@ -144,16 +207,29 @@ def get_expenses(response: Response, valid_user=Depends(verify_session)):
     - This endpoint will not be used in the client. This is just for testing purpose
     """
 
-    data = (
-        supabase.table("expense")
-        .select("id", "user_id", count="exact")
-        .eq("user_id", valid_user["id"])
-        .limit(1)
-        .execute()
-    )
+    user_id = valid_user["id"]
+
+    # Return the cached count if it was fetched recently
+    count = None
+    cached = expense_count_cache.get(user_id)
+    if cached is not None:
+        cached_count, cached_at = cached
+        if monotonic() - cached_at < EXPENSE_COUNT_CACHE_TTL:
+            count = cached_count
+
+    if count is None:
+        data = (
+            supabase.table("expense")
+            .select("id", count="exact", head=True)
+            .eq("user_id", user_id)
+            .execute()
+        )
+        count = data.count
+
+        cache_put(expense_count_cache, user_id, count, EXPENSE_COUNT_CACHE_MAX_SIZE)
 
     return api_response(
-        message=f"Expenses fetched! Row count - {data.count}",
+        message=f"Expenses fetched! Row count - {count}",
     )
 
 
@@ -166,61 +242,55 @@ def process_expenses(user_id, mail_df=None):
     if mail_df is not None and mail_df.empty:
         return 0
 
-    # Select columns related to payee
-    payee_df = mail_df[["payee_upi_id", "payee_name", "transaction_date"]]
-    # Calculate rank for each payee_upi_id based on recent transaction date. Recent transaction gets rank 1
-    payee_df["rank"] = payee_df.groupby("payee_upi_id")["transaction_date"].rank(
-        method="first", ascending=False
+    # Select columns related to payee and keep the most recent name of each payee_upi_id
+    eff_payee_df = (
+        mail_df[["payee_upi_id", "payee_name", "transaction_date"]]
+        .sort_values("transaction_date", ascending=False, kind="stable")
+        .drop_duplicates(subset="payee_upi_id", keep="first")
     )
 
-    # Filter most recent names
-    eff_payee_df = payee_df[payee_df["rank"] == 1]
-
-    # Get list of new payees to be added/updated
-    payee_upi_ids = eff_payee_df["payee_upi_id"].tolist()
-
-    # Convert dataframe to list of tuples containing two values - payee_id and name(payee_name)
-    payee_data = [
-        {
-            "payee_upi_id": row.payee_upi_id,
-            "name": row.payee_name,
-            "user_id": user_id,
-        }
-        for row in eff_payee_df.itertuples(index=False)
-    ]
-
-    # Insert payees into "payee" table
-    # ON CONFLICT - this will update the name with the latest name if a payee_upi is matched
-    supabase.table("payee").upsert(payee_data, on_conflict="payee_upi_id").execute()
-
-    # Get list of all payees upserted above
-    db_payee_data = (
-        supabase.table("payee")
-        .select("id, payee_upi_id")
-        .in_("payee_upi_id", payee_upi_ids)
-        .execute()
+    # Convert dataframe to list of dicts containing two values - payee_upi_id and name(payee_name)
+    payee_data = (
+        eff_payee_df[["payee_upi_id", "payee_name"]]
+        .rename(columns={"payee_name": "name"})
+        .to_dict(orient="records")
     )
 
-    # Create dictionary mapping each payee_upi_id to each database ID
-    payee_mapping = {row["payee_upi_id"]: row["id"] for row in db_payee_data.data}
-
     # Prepare expense data
-    expense_records = [
-        {
-            "upi_ref_no": row.upi_ref_no,
-            "amount": row.amount,
-            "sender_upi_id": row.sender_upi_id,
-            "payee_id": payee_mapping.get(row.payee_upi_id),
-            "transaction_date": str(row.transaction_date),
-            "user_id": user_id,
-        }
-        for _, row in mail_df.iterrows()
-    ]
+    expense_records = (
+        mail_df[
+            ["upi_ref_no", "amount", "sender_upi_id", "payee_upi_id", "transaction_date"]
+        ]
+        .assign(transaction_date=mail_df["transaction_date"].astype(str))
+        .to_dict(orient="records")
+    )
+
+    # Map each payee_upi_id to its payee row so every batch only sends the payees it references
+    payee_by_upi_id = {row["payee_upi_id"]: row for row in payee_data}
+
+    def upsert_expense_batch(expense_batch):
+        """Upsert one batch of expenses along with the payees it references"""
+        # Sort payees so concurrent batches lock shared payee rows in the same order
+        batch_payee_upi_ids = sorted({row["payee_upi_id"] for row in expense_batch})
+        payee_batch = [payee_by_upi_id[upi_id] for upi_id in batch_payee_upi_ids]
+
+        supabase.rpc(
+            "process_expenses_batch",
+            {"p_user_id": user_id, "p_payees": payee_batch, "p_expenses": expense_batch},
+        ).execute()
+
+    # Upsert payees and expenses in batches of BATCH_SIZE expenses, one round-trip per batch
+    # Up to MAX_CONCURRENT_BATCHES batches are in flight at a time
+    # ON CONFLICT - payee names are updated to the latest name and expenses are overwritten by upi_ref_no
+    # The function resolves payee_id from the upserted payees, see sql/process_expenses_batch.sql
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_BATCHES) as executor:
+        # Consume results so that an error in any batch is raised here
+        list(
+            executor.map(upsert_expense_batch, chunked(expense_records, BATCH_SIZE))
+        )
 
-    # Insert all expenses from mail_df
-    supabase.table("expense").upsert(
-        expense_records, on_conflict="upi_ref_no"
-    ).execute()
+    # Count of this user's expenses may have changed
+    cache_pop(expense_count_cache, user_id)
 
 
 @app.post("/expenses")
@@ -247,6 +317,8 @@ def populate_all_expenses(
 
         # Truncate data and reset identity in receivers and transactions tables
         supabase.rpc("truncate_and_reset").execute()
+        with cache_lock:
+            expense_count_cache.clear()
 
         process_expenses(mail_df=mail_df, user_id=admin_user["id"])
 
@@ -286,14 +358,23 @@ def add_new_expenses(response: Response, valid_user: dict = Depends(verify_sessi
             "transaction_date"
         ]
 
-        last_transaction_date = datetime.fromisoformat(
-            last_transaction_timestamp
-        ).date()
+        last_transaction_datetime = datetime.fromisoformat(last_transaction_timestamp)
+        if last_transaction_datetime.tzinfo is None:
+            last_transaction_datetime = last_transaction_datetime.replace(
+                tzinfo=timezone.utc
+            )
 
-        recent_mail_ids = get_mail_ids(last_transaction_date)
+        recent_mail_ids = get_mail_ids(last_transaction_datetime.date())
         recent_mail_data = get_parsed_emails(recent_mail_ids)
         mail_df = get_mail_dataframe(recent_mail_data)
 
+        # IMAP search only filters by arrival date, so drop mails well before the last expense
+        # Mails within the grace period are kept, ON CONFLICT absorbs the ones already stored
+        min_transaction_datetime = last_transaction_datetime - NEW_EXPENSES_GRACE_PERIOD
+        mail_df = mail_df[mail_df["transaction_date"] >= min_transaction_datetime]
+        if mail_df.empty:
+            return api_response(message="No new expenses found")
+
         process_expenses(mail_df=mail_df, user_id=user_id)
 
         return api_response(message="expenses upserted")
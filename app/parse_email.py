@@ -1,16 +1,181 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timezone
 import email
-from email.utils import parsedate_to_datetime
+import html
+import multiprocessing
+from email.policy import default as default_policy
 import os
 import re
+from threading import Lock
 
+import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
-import pytz
 from app.search_inbox import get_mail_connection
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Opening tags of spans having class = "gmailmsg"
+SPAN_PATTERN = re.compile(r'<span[^>]*\bclass="[^"]*\bgmailmsg\b[^"]*"[^>]*>', re.I)
+# Opening and closing span tags, used to find the closing tag of a gmailmsg span
+SPAN_TAG_PATTERN = re.compile(r"<(/?)span\b[^>]*>", re.I)
+# Line breaks separating key:value pairs inside a span
+BR_PATTERN = re.compile(r"<br\s*/?>", re.I)
+# Any html tag, used to get the text of a span
+TAG_PATTERN = re.compile(r"<[^>]+>")
+
+# Own UPI ids, mails paid to any of these are credits to the account
+IDS = [upi_id for upi_id in os.getenv("IDS", "").split(",") if upi_id]
+# Regex matching any of the own UPI ids, compiled once instead of on every call
+IDS_PATTERN = re.compile("|".join(map(re.escape, IDS))) if IDS else None
+
+# Keys extracted from each transaction, in the order of final data columns
+MAIL_DATA_KEYS = (
+    "UPI Ref. No.",
+    "To VPA",
+    "From VPA",
+    "Payee Name",
+    "Amount",
+    "Transaction Date",
+)
+
+# Number of processes used to parse mails
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", os.cpu_count() or 1))
+# Minimum number of mails for which parsing is spread across processes
+PARSE_PROCESS_MIN_MAILS = 200
+# Number of mails sent to a worker process at a time
+PARSE_CHUNK_SIZE = 50
+
+# Process pool shared by all requests, created on first use
+parse_pool = None
+parse_pool_lock = Lock()
+
+# Number of mails requested in a single IMAP FETCH command
+FETCH_BATCH_SIZE = int(os.getenv("FETCH_BATCH_SIZE", 500))
+
+
+# Fetch raw RFC822 content of mails, requesting FETCH_BATCH_SIZE mails per round-trip
+def fetch_raw_mails(mail_connection, mail_ids):
+    for start in range(0, len(mail_ids), FETCH_BATCH_SIZE):
+        # IMAP accepts comma separated sequence sets
+        id_batch = mail_ids[start : start + FETCH_BATCH_SIZE]
+        status, fetched_mail_data = mail_connection.fetch(
+            b",".join(id_batch), "(RFC822)"
+        )
+
+        # continue if status not OK
+        if status != "OK":
+            continue
+
+        # Each mail is a (envelope, content) tuple, separated by closing b")" items
+        for item in fetched_mail_data:
+            if isinstance(item, tuple):
+                yield item[1]
+
+
+# Yield each gmailmsg span up to its matching closing tag, so nested spans are kept whole
+def find_gmailmsg_spans(body):
+    for open_match in SPAN_PATTERN.finditer(body):
+        depth = 1
+        for tag_match in SPAN_TAG_PATTERN.finditer(body, open_match.end()):
+            depth += -1 if tag_match.group(1) else 1
+            if depth == 0:
+                yield body[open_match.start() : tag_match.end()]
+                break
+
+
+# Parse a raw RFC822 mail into key:value lists of its successful UPI transactions
+# Kept at module level, so it can be sent to worker processes
+def parse_raw_mail(raw_bytes):
+    # define what parsed data of this mail would look like
+    parsed_mail_data = {key: [] for key in MAIL_DATA_KEYS}
+
+    # get mail message
+    raw_mail = email.message_from_bytes(raw_bytes, policy=default_policy)
+
+    # Only the html body contains transaction details
+    html_part = raw_mail.get_body(preferencelist=("html",))
+
+    # return empty data if there is no html body
+    if html_part is None:
+        return parsed_mail_data
+
+    # Get decoded body content
+    body = html_part.get_content()
+
+    # Skip bodies without a UPI reference before looking for spans
+    # Raw bytes can't be checked since the body may be base64 encoded
+    if "UPI Ref. No." not in body:
+        return parsed_mail_data
+
+    # Date header is already parsed to datetime by the default policy
+    # convert it to UTC timezone once for all spans of this mail
+    email_datetime_utc = raw_mail["Date"].datetime.astimezone(timezone.utc)
+
+    # iterate through all spans having class = "gmailmsg"
+    # These mails are machine generated, so regex is enough to extract the spans
+    for span in find_gmailmsg_spans(body):
+        # Decode html entities like &#39; and &nbsp; in the text of the span
+        span_text = html.unescape(TAG_PATTERN.sub("", span))
+
+        # Skip spans which don't contain UPI Ref No or with FAILED status
+        if "UPI Ref. No. " not in span_text:
+            continue
+        if "Transaction Status: FAILED" in span_text:
+            continue
+
+        # Get key:value pairs by splitting
+        lines = BR_PATTERN.split(span)
+        for line in lines:
+            # Skip lines that contain ':' or start with '<'
+            if line.startswith("<") or ":" not in line:
+                continue
+
+            # split only once on ":" separator to get two items - key and value
+            # decode html entities and strip each element to get cleaned values
+            pay_key, pay_val = (
+                html.unescape(item).strip() for item in line.split(":", 1)
+            )
+
+            # skip if key is not in desired data keys
+            if pay_key not in parsed_mail_data:
+                continue
+
+            if pay_key == "Transaction Date":
+                # Add element to list
+                parsed_mail_data[pay_key].append(email_datetime_utc)
+            elif pay_key == "Amount":
+                # Cast to float here, instead of converting the whole column later
+                parsed_mail_data[pay_key].append(float(pay_val))
+            else:
+                # add element to list normally
+                parsed_mail_data[pay_key].append(pay_val)
+
+    return parsed_mail_data
+
+
+# Get the shared parse pool, creating it if needed
+# Workers are spawned instead of forked, since forking a multi-threaded server can
+# copy locks held by other threads into the child and deadlock it
+def get_parse_pool():
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is None:
+            parse_pool = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return parse_pool
+
+
+# Drop the shared parse pool if a worker died, so the next call starts a new one
+def reset_parse_pool(broken_pool):
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is broken_pool:
+            parse_pool = None
+
 
 def get_parsed_emails(mail_ids):
     try:
@@ -18,77 +183,29 @@ def get_parsed_emails(mail_ids):
         mail_connection = get_mail_connection()
 
         # define what final data would look like
-        parsed_mail_data = {
-            "UPI Ref. No.": [],
-            "To VPA": [],
-            "From VPA": [],
-            "Payee Name": [],
-            "Amount": [],
-            "Transaction Date": [],
-        }
-
-        # iterate through each mail_id
-        for mail_id in mail_ids:
-            # try to fetch the mail data for the current iteration's mail_id
-            status, fetched_mail_data = mail_connection.fetch(mail_id, "(RFC822)")
-
-            # continue if status not OK
-            if status != "OK":
-                continue
+        parsed_mail_data = {key: [] for key in MAIL_DATA_KEYS}
+
+        # Raw mails are streamed from IMAP as each FETCH batch arrives
+        raw_mails = fetch_raw_mails(mail_connection, mail_ids)
+
+        # Parsing is CPU bound, so large loads are spread across processes
+        # Small loads are parsed in this process since starting workers costs more
+        if PARSE_WORKERS > 1 and len(mail_ids) >= PARSE_PROCESS_MIN_MAILS:
+            pool = get_parse_pool()
+            try:
+                for mail_data in pool.map(
+                    parse_raw_mail, raw_mails, chunksize=PARSE_CHUNK_SIZE
+                ):
+                    for key, values in mail_data.items():
+                        parsed_mail_data[key].extend(values)
+            except BrokenProcessPool:
+                reset_parse_pool(pool)
+                raise
+        else:
+            for mail_data in map(parse_raw_mail, raw_mails):
+                for key, values in mail_data.items():
+                    parsed_mail_data[key].extend(values)
 
-            # get mail message
-            raw_mail = email.message_from_bytes(fetched_mail_data[0][1])
-
-            # Walk through mail content
-            for part in raw_mail.walk():
-                # Get mail body
-                body = part.get_payload(decode=True)
-
-                # continue if body is None
-                if body is None:
-                    continue
-
-                # Parse body content
-                soup = BeautifulSoup(body, "html.parser")
-
-                # Get spans having class = "gmailmsg"
-                spans = soup.find_all("span", class_="gmailmsg")
-
-                # iterate through all valid spans
-                for span in spans:
-                    # Skip spans which don't contain UPI Ref No or with FAILED status
-                    if "UPI Ref. No. " not in span.text:
-                        continue
-                    if "Transaction Status: FAILED" in span.text:
-                        continue
-
-                    # Get key:value pairs by splitting
-                    lines = str(span).split("<br/>")
-                    for line in lines:
-                        # Skip lines that contain ':' or start with '<'
-                        if line.startswith("<") or ":" not in line:
-                            continue
-
-                        # split only once on ":" separator to get two items - key and value
-                        # strip each element and get cleaned values
-                        pay_key, pay_val = map(str.strip, line.split(":", 1))
-
-                        # skip if key is not in desired data keys
-                        if pay_key not in parsed_mail_data:
-                            continue
-
-                        if pay_key == "Transaction Date":
-                            # parse mail's date to valid datetime
-                            email_datetime = parsedate_to_datetime(raw_mail["Date"])
-
-                            # convert datetime to UTC timezone
-                            email_datetime_utc = email_datetime.astimezone(pytz.UTC)
-
-                            # Add element to list
-                            parsed_mail_data[pay_key].append(email_datetime_utc)
-                        else:
-                            # add element to list normally
-                            parsed_mail_data[pay_key].append(pay_val)
         return parsed_mail_data
     except Exception as e:
         return None
@@ -110,20 +227,19 @@ def get_mail_dataframe(email_data):
             }
         )
 
-        ids = os.getenv("IDS").split(",")
-
-        # Build regex pattern
-        ids_pattern = "|".join(map(re.escape, ids))
+        if IDS_PATTERN is None:
+            raise ValueError("IDS environment variable is not set")
 
         # Convert data types
-        mail_df["amount"] = mail_df["amount"].astype(float)
         mail_df["upi_ref_no"] = mail_df["upi_ref_no"].astype(str)
-        mail_df["transaction_date"] = pd.to_datetime(mail_df["transaction_date"])
-
-        match_mask = mail_df["payee_upi_id"].str.contains(
-            ids_pattern, regex=True, na=False
+        mail_df["transaction_date"] = pd.to_datetime(
+            mail_df["transaction_date"], utc=True, cache=True
         )
-        mail_df.loc[match_mask, "amount"] *= -1
+
+        # Negate amounts paid to own UPI ids in a single pass over the column
+        match_mask = mail_df["payee_upi_id"].str.contains(IDS_PATTERN, na=False)
+        sign = np.where(match_mask.to_numpy(dtype=bool), -1.0, 1.0)
+        mail_df["amount"] = mail_df["amount"].to_numpy(dtype=np.float64) * sign
 
         return mail_df
     except Exception as e:
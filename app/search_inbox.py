@@ -24,7 +24,8 @@ def get_mail_connection():
 # Fetch all emails or only those after the latest_date
 def get_mail_ids(latest_date: datetime = None):
     with get_mail_connection() as mail:
-        search_query = ["FROM", f'"{CHECK_MAIL}"']
+        # Only transaction mails contain a UPI reference, so skip the rest on the server
+        search_query = ["FROM", f'"{CHECK_MAIL}"', "BODY", '"UPI Ref. No."']
 
         if latest_date is not None:
             formatted_date = latest_date.strftime("%d-%b-%Y").upper()
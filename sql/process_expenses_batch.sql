@@ -0,0 +1,42 @@
+-- Upsert payees and expenses in one call
+-- Payees are upserted first and the returned ids are joined onto the expenses by payee_upi_id
+create or replace function process_expenses_batch(
+    p_user_id text,
+    p_payees jsonb,
+    p_expenses jsonb
+)
+returns void
+language sql
+as $$
+    with upserted_payee as (
+        insert into payee (payee_upi_id, name, user_id)
+        select p.payee_upi_id, p.name, p_user_id
+        from jsonb_to_recordset(p_payees) as p(payee_upi_id text, name text)
+        on conflict (payee_upi_id) do update
+            set name = excluded.name,
+                user_id = excluded.user_id
+        returning id, payee_upi_id
+    )
+    insert into expense (upi_ref_no, amount, sender_upi_id, payee_id, transaction_date, user_id)
+    select
+        e.upi_ref_no,
+        e.amount,
+        e.sender_upi_id,
+        up.id,
+        e.transaction_date,
+        p_user_id
+    from jsonb_to_recordset(p_expenses) as e(
+        upi_ref_no text,
+        amount numeric,
+        sender_upi_id text,
+        payee_upi_id text,
+        transaction_date timestamptz
+    )
+    left join upserted_payee as up using (payee_upi_id)
+    on conflict (upi_ref_no) do update
+        set amount = excluded.amount,
+            sender_upi_id = excluded.sender_upi_id,
+            payee_id = excluded.payee_id,
+            transaction_date = excluded.transaction_date,
+            user_id = excluded.user_id;
+$$;